@@ -0,0 +1,68 @@
+import re
+from collections import defaultdict
+from rake_nltk import Rake, Metric
+
+# words and punctuation symbols, like nltk.tokenize.wordpunct_tokenize but
+# every punctuation symbol is a separate token and so a phrase delimiter
+_TOKEN_RE = re.compile(r"\w+|[^\w\s]")
+
+
+def _whole_text(text):
+    return [text]
+
+
+class FastRake(Rake):
+    """
+    Rake with linear time scoring of contender phrases.
+
+    rake_nltk builds a full word co-occurrence graph and scores every phrase
+    again for each of its repetitions, which dominates the indexing time of
+    large text files. Scores are same as of `Rake`.
+
+    By default text is tokenized with a single precompiled regex instead of
+    nltk sentence and word tokenizers. Sentence boundaries are punctuation
+    symbols, which already split phrases, so the text is not split into
+    sentences first.
+    """
+
+    def __init__(self, *args, **kwargs):
+        kwargs.setdefault("sentence_tokenizer", _whole_text)
+        kwargs.setdefault("word_tokenizer", _TOKEN_RE.findall)
+        super().__init__(*args, **kwargs)
+
+    def _build_word_co_occurance_graph(self, phrase_list):
+        # every occurrence of a word co-occurs with all words of its phrase,
+        # so degree of the word is sum of length of phrases containing it
+        self.degree = defaultdict(lambda: 0)
+        for phrase in phrase_list:
+            length = len(phrase)
+            for word in phrase:
+                self.degree[word] += length
+
+    def _build_ranklist(self, phrase_list):
+        phrase_counts = defaultdict(int)
+        for phrase in phrase_list:
+            phrase_counts[phrase] += 1
+
+        word_scores = {}
+        for word, frequency in self.frequency_dist.items():
+            if self.metric == Metric.DEGREE_TO_FREQUENCY_RATIO:
+                word_scores[word] = 1.0 * self.degree[word] / frequency
+            elif self.metric == Metric.WORD_DEGREE:
+                word_scores[word] = 1.0 * self.degree[word]
+            else:
+                word_scores[word] = 1.0 * frequency
+
+        ranks = []
+        for phrase in phrase_counts:
+            rank = 0.0
+            for word in phrase:
+                rank += word_scores[word]
+            ranks.append((rank, " ".join(phrase), phrase_counts[phrase]))
+        ranks.sort(reverse=True)
+
+        # repeated phrases are kept in the rank list as rake_nltk does
+        self.rank_list = []
+        for rank, phrase, count in ranks:
+            self.rank_list.extend([(rank, phrase)] * count)
+        self.ranked_phrases = [ph[1] for ph in self.rank_list]
@@ -1,17 +1,45 @@
 import os
+import sys
 from sys import platform
 import pickle
-from typing import Dict, Union
-from rake_nltk import Rake
+from collections import OrderedDict, defaultdict
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, NamedTuple, Optional, Tuple, Union
+from fastrake import FastRake
+from error import ErrorHandler
+
+errorhandler = ErrorHandler()
+
+# bytes which are expected in a text file, used to detect binary files
+_TEXTCHARS = bytes({7, 8, 9, 10, 12, 13, 27} | set(range(0x20, 0x100)) - {0x7F})
+
+# extensions of files which are known to be binary or text files,
+# files of other extensions are detected by reading their content.
+# Extensions used by both kinds of files, like ".ts" of TypeScript and
+# MPEG transport stream, are not listed
+_BINARY_EXTS = {
+    ".png", ".jpg", ".jpeg", ".gif", ".bmp", ".ico", ".webp", ".tiff",
+    ".mp3", ".wav", ".flac", ".ogg", ".mp4", ".mkv", ".avi", ".mov", ".webm",
+    ".zip", ".gz", ".tgz", ".bz2", ".xz", ".7z", ".rar", ".tar", ".jar",
+    ".pdf", ".doc", ".docx", ".xls", ".xlsx", ".ppt", ".pptx", ".odt",
+    ".exe", ".dll", ".so", ".o", ".a", ".class", ".pyc", ".bin", ".iso",
+    ".ttf", ".otf", ".woff", ".woff2", ".sqlite", ".db",
+}
+_TEXT_EXTS = {
+    ".txt", ".md", ".rst", ".csv", ".tsv", ".json", ".yaml", ".yml", ".toml",
+    ".ini", ".cfg", ".xml", ".html", ".htm", ".css", ".tex", ".log",
+    ".py", ".c", ".h", ".cpp", ".hpp", ".java", ".js", ".go", ".rs",
+    ".sh", ".sql",
+}
 
 
 class State(object):
     __slots__ = ("free_slots", "lastid")
 
-    def __init__(self, free_slots: set = set(), lastid: int = -1) -> None:
+    def __init__(self, free_slots: Optional[set] = None, lastid: int = -1) -> None:
         # set of all ids which are not in use by any file
         # Id is set to be free when any file is deleted
-        self.free_slots = free_slots
+        self.free_slots = set() if free_slots is None else free_slots
         # Last assigned id
         self.lastid = lastid
 
@@ -23,16 +51,30 @@ class State(object):
         return f"State(\n  free_slots: {self.free_slots},\n  lastid: {self.lastid}\n)"
 
 
+class UniqueMetadata(NamedTuple):
+    """
+    Unique metadata of a file, device id and inode identify the file
+    while modification time detects the changes of it
+    """
+    st_dev: int
+    st_ino: int
+    st_mtime_ns: int
+
+    @property
+    def key(self) -> Tuple[int, int]:
+        return (self.st_dev, self.st_ino)
+
+
 class Metadata(object):
     __slots__ = ("keywords", "user_keywords", "path", "u_meta")
 
-    def __init__(self, keywords: set, user_keywords : set, path: str, u_meta : Union[os.stat_result, None]) -> None:
+    def __init__(self, keywords: frozenset, user_keywords : frozenset, path: str, u_meta : Union[UniqueMetadata, None]) -> None:
         self.keywords = keywords
         self.user_keywords = user_keywords
         # full path of the file relative to peregrine home
         self.path = path
         # unique metadata
-        # inode and device id for linux
+        # device id, inode and modification time for linux
         self.u_meta = u_meta
 
     def __str__(self) -> str:
@@ -40,40 +82,72 @@ class Metadata(object):
 
 
 class IndexTable(object):
-    __slots__ = ("state", "files", "name", "keywords", "path", "uid")
+    __slots__ = (
+        "state", "files", "name", "keywords", "path", "uid", "keyword_cache", "version",
+        "keyword_blooms", "mtimes_by_uid",
+    )
+
+    # number of bits in bloom filter of posting set of a keyword
+    BLOOM_BITS = 1024
 
     def __init__(
         self,
-        state: State = State(),
-        files: Dict[int, Metadata] = {},
-        name: Dict[str, set] = {},
-        keywords: Dict[str, set] = {},
-        path: Dict[str, int] = {},
-        uid: Dict[os.stat_result, int] = {},
+        state: Optional[State] = None,
+        files: Optional[Dict[int, Metadata]] = None,
+        name: Optional[Dict[str, set]] = None,
+        keywords: Optional[Dict[str, set]] = None,
+        path: Optional[Dict[str, int]] = None,
+        uid: Optional[Dict[Tuple[int, int], int]] = None,
+        keyword_cache: Optional[OrderedDict] = None,
+        version: int = 0,
+        keyword_blooms: Optional[Dict[str, int]] = None,
+        mtimes_by_uid: Optional[Dict[int, int]] = None,
     ) -> None:
+        # defaults are created per instance, so that tables do not share them
+
         # metadata stored by peregrine for its usage
-        self.state = state
+        self.state = State() if state is None else state
 
         # file metadata with mapping id->Metadata
         # where id is unique id assigned by peregrine
         # mapping type: int -> Metadata
-        self.files = files
+        self.files = {} if files is None else files
 
         # mapping of file name->ids which have same name
         # mapping type: str -> set(int)
-        self.name = name
+        self.name = defaultdict(set) if name is None else name
 
         # mapping of keywords->ids which are related to that keyword
         # mapping type: str -> set(int)
-        self.keywords = keywords
+        self.keywords = defaultdict(set) if keywords is None else keywords
 
         # full path from peregrine home -> id
         # mapping type: str -> int
-        self.path = path
+        self.path = {} if path is None else path
 
         # mapping from system unique identifier -> peregrine id
-        # mapping type: os.stat_result -> int
-        self.uid = uid
+        # mapping type: (st_dev, st_ino) -> int
+        self.uid = {} if uid is None else uid
+
+        # extracted keywords of recently indexed files in LRU order, so that
+        # renamed or re-added unchanged files are not read again
+        # mapping type: UniqueMetadata -> frozenset(str)
+        self.keyword_cache = OrderedDict() if keyword_cache is None else keyword_cache
+
+        # incremented on every change of the table, so that data derived
+        # from the table can be cached until it changes
+        self.version = version
+
+        # bloom filter of posting set of every keyword as an integer bitmap with
+        # bit `id % BLOOM_BITS` set for every id which is or was in the set.
+        # Bits are not cleared on removal, so a filter can only give false positives
+        # mapping type: str -> int
+        self.keyword_blooms = {} if keyword_blooms is None else keyword_blooms
+
+        # modification time in nanoseconds of files with unique metadata, so that
+        # time constraint of search does not go through metadata of every file
+        # mapping type: int -> int
+        self.mtimes_by_uid = {} if mtimes_by_uid is None else mtimes_by_uid
 
     def __str__(self) -> str:
         files_str = "\n  ".join([f"{k}: {str(v)}" for k,v in self.files.items()])
@@ -86,28 +160,43 @@ class Indexer:
     To index files and directories present in the peregrine home.
     """
 
-    index_table = IndexTable()
-
     CURRENT_DIRECTORY = ""
     HOME_DIRECTORY = ""
     # *nix system, assumes file system which *nix system is using supports inodes
     NIX = True
+    # minimum number of files to be indexed for using worker processes
+    PARALLEL_THRESHOLD = 64
+    # maximum number of characters read from a file for keyword extraction,
+    # keywords of a large file are mostly found in this part of it
+    KEYWORDS_READ_LIMIT = 2 * 1024 * 1024
+    # maximum number of files whose extracted keywords are cached
+    KEYWORD_CACHE_SIZE = 8192
 
     def __init__(self, home_directory) -> None:
+        # created per instance, so that indexers do not share one table
+        self.index_table = IndexTable()
         self.HOME_DIRECTORY = os.path.abspath(os.path.expanduser(home_directory))
         self.CURRENT_DIRECTORY = self.HOME_DIRECTORY
         if platform == "linux" or platform == "linux2" or platform == "darwin":
             self.NIX = True
         else:
             self.NIX = False
+        # RAKE keeps no state between texts, so one instance serves every file.
+        # It is created on first extraction, as it loads nltk stopwords
+        self._rake = None
+        # error in loading nltk stopwords, so that it is logged only once
+        self._rake_error = None
 
-    def get_unique_metadata(self, file):
+    def get_unique_metadata(self, file, stat=None):
         """
         Returns unique metadata for file or directory
-        Returns inode, id of device and number of links for linux
+        Returns id of device, inode and modification time for linux
+        If `stat` of the file is already known, it is used instead of calling stat again
         """
         if self.NIX:
-            return os.stat(file)
+            if stat is None:
+                stat = os.stat(file)
+            return UniqueMetadata(stat.st_dev, stat.st_ino, stat.st_mtime_ns)
         else:
             return None
 
@@ -115,48 +204,133 @@ class Indexer:
         """
         Checks if file is a binary file
         """
-        textchars = bytearray(
-            {7, 8, 9, 10, 12, 13, 27} | set(range(0x20, 0x100)) - {0x7F}
-        )
+        ext = os.path.splitext(filename)[1].lower()
+        if ext in _BINARY_EXTS:
+            return True
+        if ext in _TEXT_EXTS:
+            return False
         with open(filename, "rb") as f:
-            is_binary_string = bool(f.read(1024).translate(None, textchars))
+            is_binary_string = bool(f.read(1024).translate(None, _TEXTCHARS))
         return is_binary_string
 
+    def get_rake(self):
+        """
+        Returns RAKE instance, None if nltk stopwords are not downloaded
+        """
+        if self._rake is None and self._rake_error is None:
+            try:
+                self._rake = FastRake()
+            # nltk raises LookupError itself, not a subclass of it, for data
+            # which is not downloaded
+            except LookupError as e:
+                self._rake_error = e
+                errorhandler.log_warning(f"Could not load keyword extractor: {e}")
+        return self._rake
+
     def get_keywords(self, filename):
         """
         Extracts keyword phrases from text file using RAKE
         """
-        rake = Rake()
-        with open(filename) as f:
-            rake.extract_keywords_from_text(f.read())
+        rake = self.get_rake()
+        with open(filename, encoding="utf-8", errors="ignore") as f:
+            rake.extract_keywords_from_text(f.read(self.KEYWORDS_READ_LIMIT))
             return rake.get_ranked_phrases()
 
-    def index_file(self, filename):
+    def extract_keywords(self, filename):
+        """
+        Returns set of keywords of the file, empty set for binary files
+        and None if keywords could not be extracted
+        """
+        if self.is_binary_file(filename):
+            return set()
+        if self.get_rake() is None:
+            return None
+        try:
+            return {w for phrase in self.get_keywords(filename) for w in phrase.split()}
+        except (OSError, ValueError) as e:
+            errorhandler.log_warning(f"Could not extract keywords from {filename}: {e}")
+            return None
+
+    def get_cached_keywords(self, u_meta):
+        """
+        Returns keywords extracted earlier from the file with same unique metadata,
+        None if they are not cached
+        """
+        if u_meta is None:
+            return None
+        cache = self.index_table.keyword_cache
+        keywords = cache.get(u_meta)
+        if keywords is not None:
+            cache.move_to_end(u_meta)
+        return keywords
+
+    def cache_keywords(self, u_meta, keywords):
+        """
+        Caches extracted keywords of the file, evicting least recently used entry when full
+        """
+        if u_meta is None:
+            return
+        cache = self.index_table.keyword_cache
+        cache[u_meta] = frozenset(keywords)
+        cache.move_to_end(u_meta)
+        if len(cache) > self.KEYWORD_CACHE_SIZE:
+            cache.popitem(last=False)
+
+    def is_modified(self, filepath, stat):
+        """
+        Checks if file at `filepath` relative to peregrine home is changed
+        or not indexed yet
+        """
+        if filepath not in self.index_table.path:
+            return True
+        old_stat = self.index_table.files[self.index_table.path[filepath]].u_meta
+        return stat != old_stat
+
+    def index_file(self, filename, dirpath=None, stat=None, keywords=None, filepath=None, cacheable=True):
         """
         Index the file and add entry to IndexTable
+        `dirpath` is full path of the directory containing the file, defaults to current directory
+        `stat` is the result of stat on the file, if caller already has it
+        `keywords` are the extracted keywords of the file, if caller already has them
+        `filepath` is path of the file relative to peregrine home, if caller already has it
+        `cacheable` is False if `keywords` are not a result of successful extraction
         """
 
-        full_filepath = os.path.join(self.CURRENT_DIRECTORY, filename)
-        filepath = os.path.relpath(full_filepath, self.HOME_DIRECTORY)
+        if dirpath is None:
+            dirpath = self.CURRENT_DIRECTORY
+        full_filepath = os.path.join(dirpath, filename)
+        if filepath is None:
+            filepath = os.path.relpath(full_filepath, self.HOME_DIRECTORY)
+        cur_stat = self.get_unique_metadata(full_filepath, stat)
+        if not self.is_modified(filepath, cur_stat):
+            return
         tracked_file = filepath in self.index_table.path
 
         unique_id = None
         if tracked_file:
             unique_id = self.index_table.path[filepath]
-            old_keywords = self.index_table.files[unique_id].keywords
-        
-            cur_stat = self.get_unique_metadata(full_filepath)
-            stat = self.index_table.files[unique_id].u_meta
-            if cur_stat.st_ino == stat.st_ino and cur_stat.st_mtime == stat.st_mtime:
-                return
-
-        # extract keywords from file if it is text file
-        keywords = set()
-        if not self.is_binary_file(full_filepath):
-            try:
-                keywords = set(" ".join(self.get_keywords(full_filepath)).split())
-            except:
-                pass
+            metadata = self.index_table.files[unique_id]
+            old_keywords = metadata.keywords
+            if metadata.u_meta is not None:
+                self.index_table.uid.pop(metadata.u_meta.key, None)
+            metadata.u_meta = cur_stat
+
+        # extract keywords from file if it is text file, unless they are known
+        if keywords is None:
+            keywords = self.get_cached_keywords(cur_stat)
+            if keywords is None:
+                keywords = self.extract_keywords(full_filepath)
+        # file is indexed without keywords if extraction failed, which is not
+        # cached, so that it is extracted again once the cause is fixed
+        if keywords is None:
+            keywords = ()
+            cacheable = False
+        # same keyword of different files shares one interned string, which is
+        # also the key in keyword table. Keywords from worker processes are
+        # not interned in this process, so it is done here for all of them.
+        keywords = frozenset(map(sys.intern, keywords))
+        if cacheable:
+            self.cache_keywords(cur_stat, keywords)
 
         #
         if not tracked_file:
@@ -168,48 +342,102 @@ class Indexer:
                 # get next unique id for file entry
                 unique_id = self.index_table.state.get_nextid()
 
-            old_keywords = set()
-
-            self.index_table.files[unique_id] = Metadata(keywords, set(), filepath, self.get_unique_metadata(full_filepath))
-
-        keywords.update(self.index_table.files[unique_id].user_keywords)
-        self.index_table.files[unique_id].keywords = keywords
-        for i in old_keywords - keywords:  # in old keywords but not in new keywords
-            if i not in self.index_table.keywords:
-                self.index_table.keywords[i] = set()
-            self.index_table.keywords[i].discard(unique_id)
-        for i in keywords - old_keywords:  # in new keywords but not in old keywords
-            if i not in self.index_table.keywords:
-                self.index_table.keywords[i] = set()
-            self.index_table.keywords[i].update((unique_id,))
-        
-        if filename in self.index_table.name:
-            self.index_table.name[filename].update((unique_id,))
-        else:
-            self.index_table.name[filename] = {unique_id,}
-        
+            old_keywords = frozenset()
+
+            self.index_table.files[unique_id] = Metadata(frozenset(), frozenset(), filepath, cur_stat)
+
+        metadata = self.index_table.files[unique_id]
+        keywords = frozenset(keywords).union(metadata.user_keywords)
+        metadata.keywords = keywords
+        removed = old_keywords - keywords  # in old keywords but not in new keywords
+        added = keywords - old_keywords  # in new keywords but not in old keywords
+        keyword_table = self.index_table.keywords
+        for i in removed:
+            keyword_table[i].discard(unique_id)
+        keyword_blooms = self.index_table.keyword_blooms
+        bloom_bit = 1 << (unique_id % IndexTable.BLOOM_BITS)
+        for i in added:
+            keyword_table[i].add(unique_id)
+            keyword_blooms[i] = keyword_blooms.get(i, 0) | bloom_bit
+
+        self.index_table.name[filename].add(unique_id)
+
         self.index_table.path[filepath] = unique_id
 
         # Required to store u_meta to id mapping, to detect renaming and deletion of files.
-        self.index_table.uid[self.index_table.files[unique_id].u_meta] = unique_id
+        if cur_stat is not None:
+            self.index_table.uid[cur_stat.key] = unique_id
+            self.index_table.mtimes_by_uid[unique_id] = cur_stat.st_mtime_ns
+        else:
+            self.index_table.mtimes_by_uid.pop(unique_id, None)
 
-    def index_directory(self, dirname=""):
-        full_dirpath = os.path.join(self.CURRENT_DIRECTORY, dirname)
-        temp_current_dir = self.CURRENT_DIRECTORY
+        self.index_table.version += 1
 
-        self.CURRENT_DIRECTORY = full_dirpath
-        for entry in os.listdir(full_dirpath):
-            full_entry_path = os.path.join(full_dirpath, entry)
-            if os.path.isdir(full_entry_path):
-                self.index_directory(entry)
-            elif os.path.isfile(full_entry_path):
-                self.index_file(entry)
-        
-        self.CURRENT_DIRECTORY = temp_current_dir
+    def index_directory(self, dirname=""):
+        """
+        Index all files of the directory and its subdirectories
+        """
+        # files which are changed or not indexed yet
+        pending = []
+        # directories are walked with an explicit stack instead of recursion.
+        # Path relative to peregrine home is tracked with each directory, so
+        # it is not computed again for every file.
+        start_dirpath = os.path.join(self.CURRENT_DIRECTORY, dirname)
+        start_reldir = os.path.relpath(start_dirpath, self.HOME_DIRECTORY)
+        stack = [(start_dirpath, "" if start_reldir == os.curdir else start_reldir + os.sep)]
+        while stack:
+            full_dirpath, reldir = stack.pop()
+            # scandir gets the entry type with directory listing, so no extra
+            # stat call is needed per entry for the type checks.
+            # Symlinks are not followed, which also avoids symlink loops.
+            with os.scandir(full_dirpath) as entries:
+                for entry in entries:
+                    if entry.is_dir(follow_symlinks=False):
+                        stack.append((entry.path, f"{reldir}{entry.name}{os.sep}"))
+                    elif entry.is_file(follow_symlinks=False):
+                        stat = self.get_unique_metadata(entry.path, entry.stat(follow_symlinks=False))
+                        filepath = reldir + entry.name
+                        if self.is_modified(filepath, stat):
+                            pending.append((entry.name, full_dirpath, filepath, stat))
+
+        uncached = [p for p in pending if self.get_cached_keywords(p[3]) is None]
+        if len(uncached) >= self.PARALLEL_THRESHOLD:
+            # keywords are extracted in worker processes, as extraction of each
+            # file is independent and CPU bound. The index table is updated
+            # only in this process.
+            full_filepaths = [os.path.join(d, f) for f, d, _, _ in uncached]
+            with ProcessPoolExecutor(initializer=_init_worker) as executor:
+                results = executor.map(_extract_keywords, full_filepaths, chunksize=16)
+                for (filename, full_dirpath, filepath, stat), keywords in zip(uncached, results):
+                    # failed extraction is not retried in this process
+                    cacheable = keywords is not None
+                    if keywords is None:
+                        keywords = ()
+                    self.index_file(filename, full_dirpath, stat, keywords, filepath, cacheable)
+
+        # files which are indexed above are skipped as unmodified
+        for filename, full_dirpath, filepath, stat in pending:
+            self.index_file(filename, full_dirpath, stat, filepath=filepath)
 
 
     def dump(self, file):
-        pickle.dump(self.index_table, file)
+        pickle.dump(self.index_table, file, protocol=pickle.HIGHEST_PROTOCOL)
     
     def load(self, file):
-        self.index_table = pickle.load(file)
\ No newline at end of file
+        self.index_table = pickle.load(file)
+
+
+# Indexer of a worker process, used only to extract keywords
+_worker_indexer = None
+
+
+def _init_worker():
+    global _worker_indexer
+    _worker_indexer = Indexer("")
+
+
+def _extract_keywords(filename):
+    """
+    Extracts keywords of the file in a worker process of `Indexer.index_directory`
+    """
+    return _worker_indexer.extract_keywords(filename)
@@ -7,7 +7,7 @@ import os
 from codes import *
 from error import ErrorHandler
 import readline
-from pathlib import Path
+import shlex
 
 PEREGRINE_DIR_NAME = ".peregrine"
 PEREGRINE_FILE_NAME = "peregrinefile"
@@ -70,87 +70,108 @@ class ArgumentParser(argparse.ArgumentParser):
 
 
 class CommandHandler:
-    # Create the argument parser
-    parser = ArgumentParser(
-        prog="peregrine",
-        description="Command-line tool for indexing and searching files.",
-    )
+    # positional arguments with their defaults of the commands which have no
+    # flags, these are dispatched in interactive mode without argparse
+    SIMPLE_COMMANDS = {
+        "pwd": (),
+        "ls": (),
+        "cd": (("directory", "."),),
+    }
 
-    # Add the 'init' command
-    subparser = parser.add_subparsers(dest="command")
-    init_parser = subparser.add_parser("init", help="Initialize the tool")
-    init_parser.add_argument(
-        "path",
-        nargs="?",
-        default=os.getcwd(),
-        help="Path to initialize the tool (default: current directory)",
-    )
-    init_parser.add_argument(
-        "--force", action="store_true", help="Forcefully initialize the tool"
-    )
+    # Variables
+    PWD = None
+    HOME = None
+    # HOME ending with path separator, to check if a path is inside HOME
+    HOME_PREFIX = None
 
-    # Add the 'ls' command
-    subparser.add_parser("ls", help="List files and directories")
+    def __init__(self) -> None:
+        self.build_parser()
+        self.func_mapping = {
+            "init": self.init,
+            "help": self.help,
+            "pwd": self.pwd,
+            "ls": self.ls,
+            "cd": self.cd,
+        }
 
-    # Add the 'cd' command
-    cd_parser = subparser.add_parser("cd", help="Change directory")
-    cd_parser.add_argument(
-        "directory",
-        nargs="?",
-        default=".",
-        help="Path to the directory (default: current directory)",
-    )
+    def build_parser(self):
+        # Create the argument parser
+        self.parser = ArgumentParser(
+            prog="peregrine",
+            description="Command-line tool for indexing and searching files.",
+        )
 
-    # Add the 'pwd' command
-    pwd_parser = subparser.add_parser("pwd", help="Print current working directory")
-
-    # Add the 'meta' command
-    meta_parser = subparser.add_parser("meta", help="Perform meta operations")
-    meta_parser.add_argument("path", help="Path for meta operation")
-    meta_group = meta_parser.add_mutually_exclusive_group()
-    meta_group.add_argument("--add", nargs="+", help="Add keywords to a file")
-    meta_group.add_argument("--rm", nargs="+", help="Remove keywords from a file")
-    meta_group.add_argument(
-        "--clear", action="store_true", help="Clear all keywords from a file"
-    )
+        # Add the 'init' command
+        self.subparser = self.parser.add_subparsers(dest="command")
+        init_parser = self.subparser.add_parser("init", help="Initialize the tool")
+        init_parser.add_argument(
+            "path",
+            nargs="?",
+            default=os.getcwd(),
+            help="Path to initialize the tool (default: current directory)",
+        )
+        init_parser.add_argument(
+            "--force", action="store_true", help="Forcefully initialize the tool"
+        )
 
-    # Add the 'search' command
-    search_parser = subparser.add_parser("search", help="Search for files")
-    search_parser.add_argument(
-        "query", help="Query string for searching by name or keywords"
-    )
-    search_parser.add_argument(
-        "--date",
-        nargs=2,
-        metavar=("OPERATOR", "DATE"),
-        help="Search by date (before, after, on)",
-    )
-    search_parser.add_argument(
-        "--time",
-        nargs=2,
-        metavar=("OPERATOR", "TIME"),
-        help="Search by time (before, after, on)",
-    )
-    search_group = search_parser.add_mutually_exclusive_group()
-    search_group.add_argument(
-        "--name", action="store_true", help="Search by name only"
-    )
-    search_group.add_argument(
-        "--keyword", action="store_true", help="Search by keyword only"
-    )
+        # Add the 'ls' command
+        self.subparser.add_parser("ls", help="List files and directories")
 
-    # Add 'help' command
-    help_parser = subparser.add_parser("help", help="Show help for a specific command")
-    help_parser.add_argument(
-        "help_command",
-        nargs="?",
-        choices=subparser.choices.keys(),
-        help="Command to show help for",
-    )
+        # Add the 'cd' command
+        cd_parser = self.subparser.add_parser("cd", help="Change directory")
+        cd_parser.add_argument(
+            "directory",
+            nargs="?",
+            default=".",
+            help="Path to the directory (default: current directory)",
+        )
 
-    # Variables
-    PWD = None
-    HOME = None
+        # Add the 'pwd' command
+        self.subparser.add_parser("pwd", help="Print current working directory")
+
+        # Add the 'meta' command
+        meta_parser = self.subparser.add_parser("meta", help="Perform meta operations")
+        meta_parser.add_argument("path", help="Path for meta operation")
+        meta_group = meta_parser.add_mutually_exclusive_group()
+        meta_group.add_argument("--add", nargs="+", help="Add keywords to a file")
+        meta_group.add_argument("--rm", nargs="+", help="Remove keywords from a file")
+        meta_group.add_argument(
+            "--clear", action="store_true", help="Clear all keywords from a file"
+        )
+
+        # Add the 'search' command
+        search_parser = self.subparser.add_parser("search", help="Search for files")
+        search_parser.add_argument(
+            "query", help="Query string for searching by name or keywords"
+        )
+        search_parser.add_argument(
+            "--date",
+            nargs=2,
+            metavar=("OPERATOR", "DATE"),
+            help="Search by date (before, after, on)",
+        )
+        search_parser.add_argument(
+            "--time",
+            nargs=2,
+            metavar=("OPERATOR", "TIME"),
+            help="Search by time (before, after, on)",
+        )
+        search_group = search_parser.add_mutually_exclusive_group()
+        search_group.add_argument(
+            "--name", action="store_true", help="Search by name only"
+        )
+        search_group.add_argument(
+            "--keyword", action="store_true", help="Search by keyword only"
+        )
+
+        # Add 'help' command
+        help_parser = self.subparser.add_parser("help", help="Show help for a specific command")
+        help_parser.add_argument(
+            "help_command",
+            nargs="?",
+            choices=self.subparser.choices.keys(),
+            help="Command to show help for",
+        )
 
     # Methods
     def check_env_and_exit(self):
@@ -163,6 +184,7 @@ class CommandHandler:
         global PEREGRINE_PS1
         self.check_env_and_exit()
         self.HOME = os.getcwd()
+        self.HOME_PREFIX = os.path.join(os.path.abspath(self.HOME), "")
         if self.PWD is None:
             self.set_pwd(self.HOME)
 
@@ -174,17 +196,26 @@ class CommandHandler:
         )
 
     def parse(self, args):
-        func_mapping = {
-            "init": self.init,
-            "help": self.help,
-            "pwd": self.pwd,
-            "ls": self.ls,
-            "cd": self.cd,
-        }
         if args.command is not None:
             if args.command not in {"init", "help"}:
                 self.set_paths()
-            func_mapping[args.command](args)
+            self.func_mapping[args.command](args)
+
+    def parse_simple(self, tokens):
+        """
+        Returns arguments of a command which takes no flags without using argparse,
+        None if the command has to be parsed by argparse
+        """
+        if not tokens or tokens[0] not in self.SIMPLE_COMMANDS:
+            return None
+        positionals = self.SIMPLE_COMMANDS[tokens[0]]
+        values = tokens[1:]
+        if len(values) > len(positionals) or any(v.startswith("-") for v in values):
+            return None
+        args = argparse.Namespace(command=tokens[0])
+        for i, (dest, default) in enumerate(positionals):
+            setattr(args, dest, values[i] if i < len(values) else default)
+        return args
 
     def init(self, args):
         path = args.path
@@ -223,9 +254,8 @@ class CommandHandler:
         path = os.path.abspath(path)
         if not os.path.exists(path):
             return errorhandler.log(INVALID_PATH)
-        child = Path(path)
-        home = Path(self.HOME)
-        if home not in child.parents and home != child:
+        # path is normalized by abspath, so prefix comparison is enough
+        if not os.path.join(path, "").startswith(self.HOME_PREFIX):
             return errorhandler.log(OUT_OF_SCOPE_PATH)
 
         self.set_pwd(path)
@@ -242,17 +272,28 @@ class CommandHandler:
             if command == "exit":
                 break
             try:
-                args = self.parser.parse_args(command.split())
+                # shlex keeps quoted paths with spaces as single argument
+                tokens = shlex.split(command)
+            except ValueError as e:
+                errorhandler.log_error(e)
+                continue
+            try:
+                args = self.parse_simple(tokens)
+                if args is None:
+                    args = self.parser.parse_args(tokens)
                 self.parse(args)
             except ArgparserException:
                 pass
 
 
-commandhandler = CommandHandler()
-try:
-    args = commandhandler.parser.parse_args()
-    commandhandler.parse(args)
-    if args.command is None:
-        commandhandler.interactive()
-except ArgparserException:
-    pass
+# worker processes of `Indexer.index_directory` import the main module when
+# they are spawned, so the CLI runs only when peregrine is executed
+if __name__ == "__main__":
+    commandhandler = CommandHandler()
+    try:
+        args = commandhandler.parser.parse_args()
+        commandhandler.parse(args)
+        if args.command is None:
+            commandhandler.interactive()
+    except ArgparserException:
+        pass
@@ -1,18 +1,36 @@
+import calendar
 import datetime
+import functools
+import math
 import os
+from bisect import bisect_left, bisect_right
 from indexer import IndexTable
-from Levenshtein import jaro
+from rapidfuzz import process
+from rapidfuzz.distance import JaroWinkler
 from error import *
-from typing import Tuple, Set, List, Union, Literal
+from typing import Callable, FrozenSet, Tuple, Set, List, Union, Literal
 
 errorhandler = ErrorHandler()
 
 
 class Search:
-    FUZZY_THRESHOLD = 0.80
+    # Jaro-Winkler similarity, which adds `PREFIX_WEIGHT` of the remaining
+    # distance for each of up to `PREFIX_LENGTH` common prefix characters
+    FUZZY_THRESHOLD = 0.87
+    PREFIX_WEIGHT = 0.1
+    PREFIX_LENGTH = 4
 
     def __init__(self, index_table: IndexTable) -> None:
         self.index_table = index_table
+        # keys, posting sets and key lengths of `name` and `keywords` mappings of
+        # the index table as parallel lists, with the table version they are built for
+        self._vocabularies = {}
+        # results of fuzzy keyword searches, keyed by keyword and table version
+        # so that a change of the index table never returns stale results
+        self._fuzzy_keyword_cached = functools.lru_cache(maxsize=1024)(self._fuzzy_keyword)
+        # names of the index table joined by "\0" and offsets of every name
+        # in it, with the table version they are built for
+        self._name_blob = None
 
     def search_by_keyword(self, keyword: str, fuzzy: bool = False) -> Set[int]:
         """
@@ -20,12 +38,11 @@ class Search:
         mistakes when `fuzzy` is `True`.
         """
         if not fuzzy:
-            files = self.index_table.keywords[keyword]
+            # `get` does not add empty entries to the defaultdict
+            files = self.index_table.keywords.get(keyword, set())
         else:
-            files = set()
-            for i in self.index_table.keywords:
-                if jaro(i, keyword) >= self.FUZZY_THRESHOLD:
-                    files.update(self.index_table.keywords[i])
+            # cached result is shared, so callers get a copy of it
+            files = set(self._fuzzy_keyword_cached(keyword, self.index_table.version))
         return files
 
     def search_by_name(
@@ -38,15 +55,10 @@ class Search:
         of the name.
         """
         if not fuzzy:
-            files = self.index_table.name[name]
+            files = self.index_table.name.get(name, set())
         else:
-            files = set()
-            substring_check_set = set()
-            for i in self.index_table.name:
-                if jaro(i, name) >= self.FUZZY_THRESHOLD:
-                    files.update(self.index_table.name[i])
-                if name in i:
-                    substring_check_set.update(self.index_table.name[i])
+            files = set().union(*self._fuzzy_matches("name", name))
+            substring_check_set = set().union(*self._substring_matches(name))
             substring_check_set.difference_update(files)
             files = list(files)
             files.extend(substring_check_set)
@@ -60,25 +72,33 @@ class Search:
         `(low, high)` time constraint on `operation` which is `before`, `after` 
         or `on`. If `search_files` is provided then searches in only those files.
         """
-        operation = operation.strip().lower()
-        files = set()
+        in_limits = self._get_time_predicate(high, low, operation)
+        mtimes = self.index_table.mtimes_by_uid
         if search_files is None:
-            search_files = self.index_table.uid
-        for i in search_files:
-            if search_files is not None:
-                i = self.index_table.files[i].u_meta
-            if operation == "before":
-                if i.st_mtime <= high:
-                    files.update(self.index_table.uid[i])
-            elif operation == "after":
-                if i.st_mtime >= low:
-                    files.update(self.index_table.uid[i])
-            elif operation == "on":
-                if high >= i.st_mtime >= low:
-                    files.update(self.index_table.uid[i])
-            else:
-                raise ValueError("incorrect operation value")
-        return files
+            search_files = mtimes
+        # files without modification time never satisfy a time constraint
+        return {i for i in search_files if i in mtimes and in_limits(mtimes[i])}
+
+    @staticmethod
+    def _get_time_predicate(
+        high: int, low: int, operation: Literal["before", "after", "on"]
+    ) -> Callable[[int], bool]:
+        """
+        Returns a function which checks if a modification time in nanoseconds
+        satisfies `(low, high)` time constraint on `operation`.
+        """
+        operation = operation.strip().lower()
+        # limits in nanoseconds, to compare with integer modification times
+        high_ns = None if high is None else high * 1_000_000_000
+        low_ns = None if low is None else low * 1_000_000_000
+        # comparison is selected once instead of for every file
+        if operation == "before":
+            return lambda mtime: mtime <= high_ns
+        if operation == "after":
+            return lambda mtime: mtime >= low_ns
+        if operation == "on":
+            return lambda mtime: low_ns <= mtime <= high_ns
+        raise ValueError("incorrect operation value")
 
     def search_by_multiple_keywords(
         self,
@@ -91,146 +111,297 @@ class Search:
         Search multiple keywords with fuzzy search and applies time constraint if provided.
 
         Returns:
-            list of file ids in sorted order based on how likely they are close to query
+            list of file ids in sorted order based on how likely they are close to query.
+            Files in every exact result come first, then files in every fuzzy result,
+            files in any exact result and files in any fuzzy result, each file once.
         """
-        files = []
-        # set of files in to return
-        files_set = set()
+        # a new list, so that caller's list is never changed, without repeated
+        # keywords which do not change the result but are searched again
+        keywords = list(dict.fromkeys(keywords))
 
-        # temporary set of files to store result of each intermediate search
-        not_fuzzy_sets = []
+        # file id -> tier of the first result it occurs in, or None if it is
+        # out of the time constraint. Tiers are added in order, so insertion
+        # order of the dict is the order of the result
+        tiers = {}
 
         # get (low, high) limits of date and time
         epoch_limits = self._get_epoch_limits(date_in_yyyymmdd, time_in_hhmmss)
         is_time_constraint = epoch_limits[0] is not None
 
-        # Assuming larger words are more likely to be on top
-        keywords.sort(key=len)
-        # Searching without fuzzy search, assuming all spellings are correct
-        for i in keywords:
-            not_fuzzy_sets.append(self.search_by_keyword(i))
-
-        # Add files which occured in result of every keyword
-        files_set = set.intersection(*not_fuzzy_sets)
-
         if is_time_constraint:
-            files_set = self.search_by_time(
-                epoch_limits[1], epoch_limits[0], operation, files_set
+            in_limits = self._get_time_predicate(
+                epoch_limits[1], epoch_limits[0], operation
             )
+            mtimes = self.index_table.mtimes_by_uid
+
+            def add_tier(tier, tier_set):
+                # time constraint is checked once for every file, when it is
+                # first seen
+                for i in tier_set:
+                    if i not in tiers:
+                        in_time = i in mtimes and in_limits(mtimes[i])
+                        tiers[i] = tier if in_time else None
+        else:
+
+            def add_tier(tier, tier_set):
+                setdefault = tiers.setdefault
+                for i in tier_set:
+                    setdefault(i, tier)
+
+        # Searching without fuzzy search, assuming all spellings are correct.
+        # Same lookup as `search_by_keyword`, with the mapping bound once
+        keyword_table = self.index_table.keywords
+        not_fuzzy_sets = [keyword_table.get(i, set()) for i in keywords]
+        # intersection iterates the first set, so the smallest set goes first
+        not_fuzzy_sets.sort(key=len)
 
-        # pushing the set of files with correct spelling on top
-        files.extend(files_set)
+        # pushing the set of files which occured in result of every keyword,
+        # with correct spelling, on top. Posting sets are not intersected when
+        # their bloom filters show that they have no common file
+        if self._may_intersect(keywords):
+            add_tier(0, self._intersect(not_fuzzy_sets))
 
-        fuzzy_sets = []
         # Searching with fuzzy search
-        for i in keywords:
-            fuzzy_sets.append(self.search_by_keyword(i, fuzzy=True))
+        fuzzy_sets = [self.search_by_keyword(i, fuzzy=True) for i in keywords]
+        fuzzy_sets.sort(key=len)
 
         # Add files which occured in result of every fuzzy keyword search
-        fuzzy_set = set.intersection(*fuzzy_sets)
-        fuzzy_set.difference_update(files_set)
-        if is_time_constraint:
-            fuzzy_set = self.search_by_time(
-                epoch_limits[1], epoch_limits[0], operation, fuzzy_set
-            )
-        files_set.update(fuzzy_set)
-        files.extend(fuzzy_set)
+        add_tier(1, self._intersect(fuzzy_sets))
 
-        # Add files which occured in result of any keyword
-        non_fuzzy_set = set.union(*not_fuzzy_sets)
-        non_fuzzy_set.difference_update(files_set)
-        if is_time_constraint:
-            non_fuzzy_set = self.search_by_time(
-                epoch_limits[1], epoch_limits[0], operation, non_fuzzy_set
-            )
-        files_set.update(non_fuzzy_set)
-        files.extend(non_fuzzy_set)
+        # Add files which occured in result of any keyword, and then of any
+        # fuzzy keyword search, without building the unions
+        for tier_set in not_fuzzy_sets:
+            add_tier(2, tier_set)
+        for tier_set in fuzzy_sets:
+            add_tier(3, tier_set)
 
-        # Add files which occured in result of any fuzzy keyword search
-        fuzzy_set = set.union(*fuzzy_sets)
-        fuzzy_set.difference_update(files_set)
         if is_time_constraint:
-            fuzzy_set = self.search_by_time(
-                epoch_limits[1], epoch_limits[0], operation, fuzzy_set
-            )
-        files_set.update(fuzzy_set)
-        files.extend(fuzzy_set)
+            return [i for i, tier in tiers.items() if tier is not None]
+        return list(tiers)
 
+    def _may_intersect(self, keywords: List[str]) -> bool:
+        """
+        Returns `False` if posting sets of `keywords` certainly have no common
+        file, by intersecting their bloom filters.
+        """
+        keyword_blooms = self.index_table.keyword_blooms
+        bits = ~0
+        for i in keywords:
+            bits &= keyword_blooms.get(i, 0)
+            if not bits:
+                return False
+        return True
+
+    @staticmethod
+    def _intersect(sets: List[Set[int]]) -> Set[int]:
+        """
+        Returns a new set of intersection of `sets` sorted by length. Sets are
+        not hashed when the smallest one, which is first, is empty or is the only one,
+        and intersecting stops as soon as the intersection is empty.
+        """
+        if not sets or not sets[0]:
+            return set()
+        if len(sets) == 1:
+            # a copy, as posting sets of the index table must not be changed
+            return set(sets[0])
+        # the running intersection is never larger than the next set, so
+        # every step iterates the smaller operand
+        files = sets[0].intersection(sets[1])
+        for i in sets[2:]:
+            if not files:
+                break
+            files &= i
         return files
 
     def print_files(self, files):
+        files_table = self.index_table.files
         for i in files:
-            print(self.index_table.files[i].path)
+            print(files_table[i].path)
+
+    def _fuzzy_keyword(self, keyword: str, version: int) -> FrozenSet[int]:
+        """
+        Returns files of keywords similar to `keyword` in the index table of
+        `version`, which is the cache key of `_fuzzy_keyword_cached`.
+        """
+        return frozenset().union(*self._fuzzy_matches("keywords", keyword))
+
+    def _fuzzy_matches(self, mapping_name: str, query: str) -> List[Set[int]]:
+        """
+        Returns posting sets of keys of a mapping of the index table which
+        are similar to `query`.
+        Jaro similarity is at most `(2 + shorter / longer) / 3` for two
+        lengths, and the prefix boost raises it to at most `jaro + max_boost * (1 - jaro)`,
+        so only keys of lengths which can reach the threshold are scored.
+        """
+        keys, postings, lengths = self._get_vocabulary(mapping_name)
+        start, end = 0, len(keys)
+        max_boost = self.PREFIX_LENGTH * self.PREFIX_WEIGHT
+        min_jaro = (self.FUZZY_THRESHOLD - max_boost) / (1 - max_boost)
+        ratio = 3 * min_jaro - 2
+        if ratio > 0:
+            # tolerance for the rounding error of `ratio`
+            start = bisect_left(lengths, math.ceil(len(query) * ratio - 1e-9))
+            end = bisect_right(lengths, math.floor(len(query) / ratio + 1e-9))
+
+        # all candidate keys are scored in a single call into rapidfuzz
+        matches = process.extract(
+            query,
+            keys[start:end],
+            scorer=JaroWinkler.normalized_similarity,
+            scorer_kwargs={"prefix_weight": self.PREFIX_WEIGHT},
+            score_cutoff=self.FUZZY_THRESHOLD,
+            limit=None,
+        )
+        return [postings[start + i] for _, _, i in matches]
+
+    def _substring_matches(self, query: str) -> List[Set[int]]:
+        """
+        Returns posting sets of names of the index table containing `query`.
+        All names are searched at once in a single string with `str.find`,
+        which jumps to the next name after every match.
+        """
+        keys, postings, _ = self._get_vocabulary("name")
+        # names never contain "\0", so a match never spans two names. Empty
+        # query is found at the start of an empty string, with no name there
+        if "\0" in query or not keys:
+            return []
+        blob, offsets = self._get_name_blob()
+        find = blob.find
+        matches = []
+        index = find(query)
+        while index != -1:
+            i = bisect_right(offsets, index) - 1
+            matches.append(postings[i])
+            index = find(query, offsets[i] + len(keys[i]) + 1)
+        return matches
+
+    def _get_name_blob(self) -> Tuple[str, List[int]]:
+        """
+        Returns names of the vocabulary of `name` mapping joined by "\0" and
+        offsets of every name in it, built again only when the table changes.
+        """
+        version = self.index_table.version
+        cached = self._name_blob
+        if cached is None or cached[0] != version:
+            keys = self._get_vocabulary("name")[0]
+            offsets = []
+            offset = 0
+            for key in keys:
+                offsets.append(offset)
+                offset += len(key) + 1
+            cached = (version, "\0".join(keys), offsets)
+            self._name_blob = cached
+        return cached[1:]
+
+    def _get_vocabulary(
+        self, mapping_name: str
+    ) -> Tuple[List[str], List[Set[int]], List[int]]:
+        """
+        Returns keys, posting sets and lengths of keys of a mapping of the
+        index table as parallel lists sorted by length of keys. They are built
+        again only when the table changes.
+        """
+        version = self.index_table.version
+        cached = self._vocabularies.get(mapping_name)
+        if cached is None or cached[0] != version:
+            mapping = getattr(self.index_table, mapping_name)
+            # items are sorted together, so posting sets are not looked up again
+            items = sorted(mapping.items(), key=lambda item: len(item[0]))
+            keys = [k for k, _ in items]
+            cached = (version, keys, [v for _, v in items], [len(k) for k in keys])
+            self._vocabularies[mapping_name] = cached
+        return cached[1:]
 
     def _get_epoch_limits(
         self, date_in_yyyymmdd: str = None, time_in_hhmmss: str = None
     ) -> Tuple[int, int]:
+        """
+        Returns `(low, high)` epoch limits of date and time of a query. Limits
+        are computed once for the same date, time and current date, while
+        errors are logged for every query.
+        """
+        low, high, error_codes = self._compute_epoch_limits(
+            date_in_yyyymmdd, time_in_hhmmss, datetime.date.today()
+        )
+        for code in error_codes:
+            errorhandler.log(code)
+        return low, high
+
+    @staticmethod
+    @functools.lru_cache(maxsize=256)
+    def _compute_epoch_limits(
+        date_in_yyyymmdd: str, time_in_hhmmss: str, current_date: datetime.date
+    ) -> Tuple[int, int, Tuple[int, ...]]:
+        """
+        Returns `(low, high)` epoch limits and codes of errors in parsing.
+        """
         high = low = None
+        error_codes = []
         second = minutes = hour = 0
-        current_date = datetime.date.today()
         year = current_date.year
         month = current_date.month
         day = current_date.day
 
+        # components are parsed by length of the input, and both limits are
+        # assigned together, only when both of them are valid
         if date_in_yyyymmdd is not None:
+            length = len(date_in_yyyymmdd)
             try:
                 year = int(date_in_yyyymmdd[0:4])
-                month = (
-                    int(date_in_yyyymmdd[4:6]) if len(date_in_yyyymmdd) >= 5 else None
-                )
-                day = int(date_in_yyyymmdd[6:8]) if len(date_in_yyyymmdd) == 8 else None
-                if month is not None and day is not None:
-                    high_date_object = datetime.datetime(year, month, day, 23, 59, 59)
-                    low_date_object = datetime.datetime(year, month, day, 0, 0, 0)
-                if month is None:
-                    high_date_object = datetime.datetime(year, 12, 31, hour, 59, 59)
-                    low_date_object = datetime.datetime(year, 1, 1, hour, 0, 0)
-                elif day is None:
-                    last_day = self._get_last_day_of_month(year, month)
-                    high_date_object = datetime.datetime(
-                        year, month, last_day, hour, minutes, 59
+                if length == 8:
+                    month = int(date_in_yyyymmdd[4:6])
+                    day = int(date_in_yyyymmdd[6:8])
+                    low, high = (
+                        int(datetime.datetime(year, month, day, 0, 0, 0).timestamp()),
+                        int(datetime.datetime(year, month, day, 23, 59, 59).timestamp()),
+                    )
+                elif length <= 4:
+                    month = day = None
+                    low, high = (
+                        int(datetime.datetime(year, 1, 1, hour, 0, 0).timestamp()),
+                        int(datetime.datetime(year, 12, 31, hour, 59, 59).timestamp()),
                     )
-                    low_date_object = datetime.datetime(
-                        year, month, 1, hour, minutes, 0
+                else:
+                    month = int(date_in_yyyymmdd[4:6])
+                    day = None
+                    last_day = Search._get_last_day_of_month(year, month)
+                    low, high = (
+                        int(datetime.datetime(year, month, 1, hour, minutes, 0).timestamp()),
+                        int(
+                            datetime.datetime(
+                                year, month, last_day, hour, minutes, 59
+                            ).timestamp()
+                        ),
                     )
-                high = int(high_date_object.timestamp())
-                low = int(low_date_object.timestamp())
             except:
-                errorhandler.log(INVALID_DATE)
+                error_codes.append(INVALID_DATE)
 
         if time_in_hhmmss is not None:
+            length = len(time_in_hhmmss)
             try:
                 hour = int(time_in_hhmmss[0:2])
-                minutes = int(time_in_hhmmss[2:4]) if len(time_in_hhmmss) >= 4 else None
-                second = int(time_in_hhmmss[4:6]) if len(time_in_hhmmss) == 6 else None
-                if minutes is not None and second is not None:
-                    high_date_object = datetime.datetime(
-                        year, month, day, hour, minutes, second
+                if length == 6:
+                    minutes = int(time_in_hhmmss[2:4])
+                    second = int(time_in_hhmmss[4:6])
+                    low = high = int(
+                        datetime.datetime(year, month, day, hour, minutes, second).timestamp()
                     )
-                    low_date_object = datetime.datetime(
-                        year, month, day, hour, minutes, second
+                elif length < 4:
+                    low, high = (
+                        int(datetime.datetime(year, month, day, hour, 0, 0).timestamp()),
+                        int(datetime.datetime(year, month, day, hour, 59, 59).timestamp()),
                     )
-                if minutes is None:
-                    high_date_object = datetime.datetime(year, month, day, hour, 59, 59)
-                    low_date_object = datetime.datetime(year, month, day, hour, 0, 0)
-                elif second is None:
-                    high_date_object = datetime.datetime(
-                        year, month, day, hour, minutes, 59
+                else:
+                    minutes = int(time_in_hhmmss[2:4])
+                    low, high = (
+                        int(datetime.datetime(year, month, day, hour, minutes, 0).timestamp()),
+                        int(datetime.datetime(year, month, day, hour, minutes, 59).timestamp()),
                     )
-                    low_date_object = datetime.datetime(
-                        year, month, day, hour, minutes, 0
-                    )
-
-                high = int(high_date_object.timestamp())
-                low = int(low_date_object.timestamp())
             except:
-                errorhandler.log(INVALID_TIME)
-        return low, high
+                error_codes.append(INVALID_TIME)
+        return low, high, tuple(error_codes)
 
-    def _get_last_day_of_month(self, year: int, month: int) -> int:
+    @staticmethod
+    def _get_last_day_of_month(year: int, month: int) -> int:
         """ """
-        next_month = (month + 1) % 12 or 12
-        next_year = year if month != 12 else year + 1
-        first_day_next_month = datetime.date(next_year, next_month, 1)
-        last_day_current_month = first_day_next_month - datetime.timedelta(days=1)
-        return last_day_current_month.day
+        return calendar.monthrange(year, month)[1]